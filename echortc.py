@@ -1,228 +1,415 @@
-from typing import Dict, Tuple, Optional
+from typing import Dict, List, Tuple, Optional, Callable, Awaitable, Coroutine, TypeVar
+from functools import partial
 import tempfile
+import shutil
 import asyncio
-import random
-import string
+import secrets
+from concurrent.futures import ThreadPoolExecutor
+import fractions
+import itertools
 import os
 
-from attr import dataclass
+from attr import dataclass, Factory
+import av
+from av import AudioFrame, AudioResampler
 from aioice import Candidate
-from aiortc import MediaStreamTrack, RTCPeerConnection, RTCSessionDescription
+from aiortc import (MediaStreamTrack, RTCPeerConnection, RTCSessionDescription, RTCConfiguration,
+                    RTCIceServer, RTCIceCandidate)
 from aiortc.rtcicetransport import candidate_from_aioice
-from aiortc.contrib.media import MediaBlackhole, MediaRecorder, MediaPlayer, Frame, MediaStreamError
+from aiortc.contrib.media import MediaRecorder, MediaPlayer, Frame, MediaStreamError
 
 from mautrix.types import (EventType, CallEvent, CallInviteEventContent, CallAnswerEventContent,
-                           CallData, CallDataType, CallCandidatesEventContent, RoomID, UserID,
-                           CallHangupEventContent)
+                           CallData, CallDataType, CallCandidatesEventContent, CallCandidate,
+                           RoomID, UserID, CallHangupEventContent)
 
 from maubot import Plugin
 from maubot.handlers import event
 
-UniqueCallID = Tuple[RoomID, UserID, str]
+T = TypeVar("T")
+
+# The spec uses the string "1", but some clients send it as an integer
+SUPPORTED_VERSIONS = frozenset({1, "1"})
+
+# How long to wait for the end-of-candidates marker before giving up on a call
+CANDIDATE_TIMEOUT = 15.0
+
+# Keep recordings in memory when tmpfs is available
+RECORDING_DIR = "/dev/shm" if os.path.isdir("/dev/shm") else None
+
+AUDIO_SAMPLE_RATE = 48000
+AUDIO_PTIME = 0.02
+AUDIO_TIME_BASE = fractions.Fraction(1, AUDIO_SAMPLE_RATE)
+
+
+def decode_audio(path: str) -> List[AudioFrame]:
+    """Decode an audio file into frames in the same format aiortc's MediaPlayer produces."""
+    resampler = AudioResampler(format="s16", layout="stereo", rate=AUDIO_SAMPLE_RATE,
+                               frame_size=int(AUDIO_SAMPLE_RATE * AUDIO_PTIME))
+    frames = []
+    samples = 0
+    with av.open(path) as container:
+        # Resampling None at the end flushes any remaining buffered samples
+        decoded = itertools.chain(container.decode(audio=0), [None])
+        for frame in itertools.chain.from_iterable(map(resampler.resample, decoded)):
+            frame.pts = samples
+            frame.time_base = AUDIO_TIME_BASE
+            samples += frame.samples
+            frames.append(frame)
+    return frames
+
+
+@dataclass(frozen=True, slots=True)
+class CallKey:
+    room_id: RoomID
+    sender: UserID
+    call_id: str
 
 
 class ProxyTrack(MediaStreamTrack):
     _source: Optional[MediaStreamTrack]
-    _source_wait: Optional[asyncio.Future]
+    _recv: Optional[Callable[[], Awaitable[Frame]]]
+    _source_queue: asyncio.Queue
 
     def __init__(self, source: Optional[MediaStreamTrack] = None, kind: Optional[str] = None
                  ) -> None:
         super().__init__()
         self.kind = kind or source.kind
         self._source = source
-        self._source_wait = asyncio.get_running_loop().create_future() if source is None else None
+        self._recv = source.recv if source is not None else None
+        self._source_queue = asyncio.Queue(maxsize=1)
 
     def set_source(self, source: MediaStreamTrack) -> None:
-        self._source = source
-        if self._source_wait:
-            self._source_wait.set_result(None)
+        if self._source is not None:
+            self._source = source
+            self._recv = source.recv
+            return
+        # recv() is (or will be) waiting for a new source, replace any pending one
+        while not self._source_queue.empty():
+            self._source_queue.get_nowait()
+        self._source_queue.put_nowait(source)
 
     async def recv(self) -> Frame:
-        if self._source is None:
-            await self._source_wait
-        try:
-            return await self._source.recv()
-        except MediaStreamError:
-            self._source = None
-            self._source_wait = asyncio.get_running_loop().create_future()
-            await self._source_wait
-            return await self._source.recv()
+        while True:
+            # The source's bound recv method is cached so the per-frame path is a single call
+            recv = self._recv
+            if recv is None:
+                source = self._source = await self._source_queue.get()
+                recv = self._recv = source.recv
+            try:
+                return await recv()
+            except MediaStreamError:
+                if self._recv is recv:
+                    self._source = None
+                    self._recv = None
 
     def stop(self) -> None:
-        print("Proxy track stop 3:")
-        self._source.stop()
+        if self._source is not None:
+            self._source.stop()
         super().stop()
 
 
-@dataclass
+def parse_candidates(raw_candidates: List[CallCandidate]) -> Tuple[
+        List[RTCIceCandidate], List[Tuple[CallCandidate, ValueError]], bool]:
+    """Parse candidates up to the end-of-candidates marker, returning any that failed too."""
+    candidates = []
+    failed = []
+    for raw_candidate in raw_candidates:
+        if not raw_candidate.candidate:
+            return candidates, failed, True
+        try:
+            candidate = candidate_from_aioice(Candidate.from_sdp(raw_candidate.candidate))
+        except ValueError as e:
+            failed.append((raw_candidate, e))
+            continue
+        candidate.sdpMid = raw_candidate.sdp_mid
+        candidate.sdpMLineIndex = raw_candidate.sdp_m_line_index
+        candidates.append(candidate)
+    return candidates, failed, False
+
+
+async def drain(track: MediaStreamTrack) -> None:
+    """Read and discard frames from the track until it ends."""
+    while True:
+        try:
+            await track.recv()
+        except MediaStreamError:
+            return
+
+
+class ReplayTrack(MediaStreamTrack):
+    """Plays a list of pre-decoded audio frames once, paced in real time."""
+    kind = "audio"
+
+    _frames: List[AudioFrame]
+    _index: int
+    _start: Optional[float]
+    _loop: asyncio.AbstractEventLoop
+
+    def __init__(self, frames: List[AudioFrame],
+                 loop: Optional[asyncio.AbstractEventLoop] = None) -> None:
+        super().__init__()
+        self._frames = frames
+        self._index = 0
+        self._start = None
+        self._loop = loop or asyncio.get_running_loop()
+
+    async def recv(self) -> Frame:
+        if self.readyState != "live" or self._index >= len(self._frames):
+            self.stop()
+            raise MediaStreamError
+        frame = self._frames[self._index]
+        self._index += 1
+        frame_time = frame.pts * frame.time_base
+        if self._start is None:
+            self._start = self._loop.time() - frame_time
+        else:
+            await asyncio.sleep(self._start + frame_time - self._loop.time())
+        return frame
+
+
+@dataclass(slots=True)
 class WrappedConn:
+    key: CallKey
     pc: RTCPeerConnection
     prepare_waiter: asyncio.Future
     candidate_waiter: asyncio.Future
+    output_tracks: Dict[str, ProxyTrack]
+    input_tracks: Dict[str, MediaStreamTrack] = Factory(dict)
+    drains: List[asyncio.Task] = Factory(list)
+    task: Optional[asyncio.Task] = None
+    candidate_lock: asyncio.Lock = Factory(asyncio.Lock)
 
 
 class EchoRTCBot(Plugin):
-    conns: Dict[UniqueCallID, WrappedConn]
+    conns: Dict[CallKey, WrappedConn]
     party_id: str
+    executor: ThreadPoolExecutor
+    prompts: Dict[str, List[AudioFrame]]
+    rtc_config: RTCConfiguration
 
     async def start(self) -> None:
         self.conns = {}
-        self.party_id = "".join(random.choices(string.ascii_letters + string.digits, k=8))
+        self.party_id = secrets.token_urlsafe(6)
+        self.executor = ThreadPoolExecutor(max_workers=min(8, os.cpu_count() or 2),
+                                           thread_name_prefix="echortc")
+        # Same STUN server aiortc would use by default
+        self.rtc_config = RTCConfiguration(
+            iceServers=[RTCIceServer("stun:stun.l.google.com:19302")])
+        # TODO load these from the plugin archive
+        self.prompts = {name: await self.run_blocking(decode_audio, f"{name}.wav")
+                        for name in ("hello", "beep", "bye")}
 
     async def stop(self) -> None:
-        for (room_id, _, call_id), conn in self.conns.items():
-            hangup = CallHangupEventContent(call_id=call_id, version=1, party_id=self.party_id)
-            await self.client.send_message_event(room_id, EventType.CALL_HANGUP, hangup)
+        # Let running calls clean up (which uses the executor) before shutting it down
+        tasks = [conn.task for conn in self.conns.values() if conn.task]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        while self.conns:
+            key, conn = self.conns.popitem()
+            # Wake up invites still waiting for candidates so they don't time out later
+            conn.candidate_waiter.cancel()
+            hangup = CallHangupEventContent(call_id=key.call_id, version=1,
+                                            party_id=self.party_id)
+            await self.client.send_message_event(key.room_id, EventType.CALL_HANGUP, hangup)
             await conn.pc.close()
-        pass
+        self.executor.shutdown(wait=False)
+
+    def run_blocking(self, func: Callable[..., T], *args, **kwargs) -> Awaitable[T]:
+        return self.loop.run_in_executor(self.executor, partial(func, *args, **kwargs))
+
+    def create_task(self, coro: Coroutine) -> asyncio.Task:
+        # Start eagerly where supported so short tasks don't need an extra loop iteration.
+        # This is done per task rather than with set_task_factory, as the loop is shared
+        # with the rest of maubot.
+        if hasattr(asyncio, "eager_task_factory"):
+            return asyncio.eager_task_factory(self.loop, coro)
+        return self.loop.create_task(coro)
 
     @event.on(EventType.CALL_CANDIDATES)
     async def candidates(self, evt: CallEvent[CallCandidatesEventContent]) -> None:
-        unique_id = (evt.room_id, evt.sender, evt.content.call_id)
-        try:
-            conn = self.conns[unique_id]
-        except KeyError:
+        unique_id = CallKey(evt.room_id, evt.sender, evt.content.call_id)
+        conn = self.conns.get(unique_id)
+        if conn is None:
             return
         await conn.prepare_waiter
-        for raw_candidate in evt.content.candidates:
-            if not raw_candidate.candidate:
-                # End of candidates
+        # Handle events for the same call one at a time, so that an end-of-candidates marker
+        # can't overtake candidates from an earlier event that are still being added.
+        async with conn.candidate_lock:
+            to_add, failed, end_of_candidates = parse_candidates(evt.content.candidates)
+            for raw_candidate, error in failed:
+                self.log.warning("Failed to parse candidate %s for %s: %s",
+                                 raw_candidate.serialize(), evt.content.call_id, error)
+            for candidate in to_add:
+                self.log.info("Adding candidate %s for %s", candidate, evt.content.call_id)
+            await asyncio.gather(*[conn.pc.addIceCandidate(candidate) for candidate in to_add])
+            if end_of_candidates and not conn.candidate_waiter.done():
+                # Only signal after the candidates above have been added to the connection
                 conn.candidate_waiter.set_result(None)
-                break
-            try:
-                candidate = candidate_from_aioice(Candidate.from_sdp(raw_candidate.candidate))
-            except ValueError as e:
-                print(f"{e}: {raw_candidate.serialize()}")
-                continue
-            candidate.sdpMid = raw_candidate.sdp_mid
-            candidate.sdpMLineIndex = raw_candidate.sdp_m_line_index
-            self.log.info("Adding candidate %s for %s", candidate, evt.content.call_id)
-            await conn.pc.addIceCandidate(candidate)
         await self.client.send_receipt(evt.room_id, evt.event_id)
 
     @event.on(EventType.CALL_HANGUP)
     async def hangup(self, evt: CallEvent[CallHangupEventContent]) -> None:
-        try:
-            await self.conns.pop((evt.room_id, evt.sender, evt.content.call_id)).pc.close()
-            await self.client.send_receipt(evt.room_id, evt.event_id)
-        except KeyError:
+        unique_id = CallKey(evt.room_id, evt.sender, evt.content.call_id)
+        conn = self.conns.pop(unique_id, None)
+        if conn is None:
             return
+        conn.candidate_waiter.cancel()
+        await conn.pc.close()
+        await self.client.send_receipt(evt.room_id, evt.event_id)
 
-    @event.on(EventType.CALL_INVITE)
-    async def invite(self, evt: CallEvent[CallInviteEventContent]) -> None:
-        if evt.content.version != 1:
-            return
-        offer = RTCSessionDescription(sdp=evt.content.offer.sdp, type=str(evt.content.offer.type))
-        pc = RTCPeerConnection()
-        unique_id = (evt.room_id, evt.sender, evt.content.call_id)
+    def log_call(self, conn: WrappedConn, msg: str, *args) -> None:
+        self.log.info("%s " + msg, conn.key.call_id, *args)
 
-        def log_info(msg, *args):
-            self.log.info("%s " + msg, evt.content.call_id, *args)
+    def start_draining(self, conn: WrappedConn, track: MediaStreamTrack) -> None:
+        conn.drains.append(self.create_task(drain(track)))
 
-        log_info("Created for %s", evt.sender)
+    @staticmethod
+    def stop_draining(conn: WrappedConn) -> None:
+        for drain_task in conn.drains:
+            drain_task.cancel()
+        conn.drains.clear()
 
-        conn = self.conns[unique_id] = WrappedConn(pc=pc,
-                                                   candidate_waiter=self.loop.create_future(),
-                                                   prepare_waiter=self.loop.create_future())
+    async def run_call(self, conn: WrappedConn) -> None:
+        self.log_call(conn, "Starting task")
+        # Phases are scheduled against a single baseline so that time spent setting up
+        # recorders and players doesn't push back every later phase.
+        start = self.loop.time()
 
-        # TODO load these from the plugin archive
-        hello = MediaPlayer("hello.wav")
-        beep = MediaPlayer("beep.wav")
-        bye = MediaPlayer("bye.wav")
-        input_tracks = {}
+        async def sleep_until(offset: float) -> None:
+            await asyncio.sleep(max(0.0, start + offset - self.loop.time()))
+
+        await sleep_until(8.1)
+        self.log_call(conn, "Stopping draining input")
+        self.stop_draining(conn)
+        tmpdir = await self.run_blocking(tempfile.mkdtemp, dir=RECORDING_DIR)
+        try:
+            self.log_call(conn, "Starting recording to %s", tmpdir)
+            # Audio is kept as lossless PCM so the echo isn't re-encoded on top of Opus
+            recording_files = {"audio": os.path.join(tmpdir, "recording.wav"),
+                               "video": os.path.join(tmpdir, "recording.mp4")}
+            recording_formats = {"audio": "wav", "video": "mp4"}
+            recorders = {}
+            for kind, track in conn.input_tracks.items():
+                recorder = await self.run_blocking(MediaRecorder, recording_files[kind],
+                                                   format=recording_formats[kind])
+                recorder.addTrack(track)
+                await recorder.start()
+                recorders[kind] = recorder
+            self.log_call(conn, "Waiting for recording to finish")
+            await sleep_until(18.1)
+            self.log_call(conn, "Stopping recording and beeping")
+            for recorder in recorders.values():
+                await recorder.stop()
+            conn.output_tracks["audio"].set_source(ReplayTrack(self.prompts["beep"], self.loop))
+            self.log_call(conn, "Re-enabling draining input")
+            for track in conn.input_tracks.values():
+                self.start_draining(conn, track)
+            self.log_call(conn, "Waiting for beep to finish")
+            await sleep_until(19.6)
+            self.log_call(conn, "Playing back recording")
+            for kind in recorders:
+                playback = await self.run_blocking(MediaPlayer, recording_files[kind],
+                                                   format=recording_formats[kind])
+                conn.output_tracks[kind].set_source(getattr(playback, kind))
+            self.log_call(conn, "Waiting for playback to finish")
+            await sleep_until(29.6)
+        finally:
+            await self.run_blocking(shutil.rmtree, tmpdir, ignore_errors=True)
+        self.log_call(conn, "Stopping playback")
+        conn.output_tracks["audio"].set_source(ReplayTrack(self.prompts["bye"], self.loop))
+        self.log_call(conn, "Waiting for end message")
+        await sleep_until(34.6)
+        self.log_call(conn, "Hanging up")
+        self.conns.pop(conn.key, None)
+        hangup = CallHangupEventContent(call_id=conn.key.call_id, version=1,
+                                        party_id=self.party_id)
+        await self.client.send_message_event(conn.key.room_id, EventType.CALL_HANGUP, hangup)
+        await conn.pc.close()
+
+    async def handle_connection_state_change(self, conn: WrappedConn) -> None:
+        self.log_call(conn, "Connection state is %s", conn.pc.connectionState)
+        if conn.pc.connectionState == "failed":
+            await conn.pc.close()
+            self.conns.pop(conn.key, None)
+        if conn.pc.connectionState == "connected":
+            conn.task = self.create_task(self.run_call(conn))
+
+    def handle_track(self, conn: WrappedConn, track: MediaStreamTrack) -> None:
+        conn.input_tracks[track.kind] = track
+        self.start_draining(conn, track)
+        conn.pc.addTrack(conn.output_tracks[track.kind])
+        track.on("ended", partial(self.handle_track_ended, conn, track))
+
+    async def handle_track_ended(self, conn: WrappedConn, track: MediaStreamTrack) -> None:
+        self.log_call(conn, "Track %s ended", track.kind)
+        self.stop_draining(conn)
+
+    @event.on(EventType.CALL_INVITE)
+    async def invite(self, evt: CallEvent[CallInviteEventContent]) -> None:
+        if evt.content.version not in SUPPORTED_VERSIONS:
+            return
+        offer = RTCSessionDescription(sdp=evt.content.offer.sdp, type=str(evt.content.offer.type))
+        pc = RTCPeerConnection(configuration=self.rtc_config)
+        unique_id = CallKey(evt.room_id, evt.sender, evt.content.call_id)
         output_tracks = {
-            "audio": ProxyTrack(source=hello.audio),
+            "audio": ProxyTrack(source=ReplayTrack(self.prompts["hello"], self.loop)),
             "video": ProxyTrack(kind="video"),
         }
-        blackhole = MediaBlackhole()
-
-        async def task() -> None:
-            log_info("Starting task")
-            await asyncio.sleep(8.1)
-            log_info("Stopping blackhole")
-            await blackhole.stop()
-            with tempfile.TemporaryDirectory() as tmpdir:
-                log_info("Starting recording to %s", tmpdir)
-                wav_file = os.path.join(tmpdir, "recording.wav")
-                mp4_file = os.path.join(tmpdir, "recording.mp4")
-                audio_recorder = MediaRecorder(wav_file, format="wav")
-                audio_recorder.addTrack(input_tracks["audio"])
-                await audio_recorder.start()
-                if "video" in input_tracks:
-                    video_recorder = MediaRecorder(mp4_file, format="mp4")
-                    video_recorder.addTrack(input_tracks["video"])
-                    await video_recorder.start()
-                else:
-                    video_recorder = None
-                log_info("Waiting for recording to finish")
-                await asyncio.sleep(10)
-                log_info("Stopping recording and beeping")
-                await audio_recorder.stop()
-                if video_recorder:
-                    await video_recorder.stop()
-                output_tracks["audio"].set_source(beep.audio)
-                log_info("Re-enabling blackhole")
-                for track in input_tracks.values():
-                    blackhole.addTrack(track)
-                await blackhole.start()
-                log_info("Waiting for beep to finish")
-                await asyncio.sleep(1.5)
-                log_info("Playing back recording")
-                audio_playback = MediaPlayer(wav_file, format="wav")
-                output_tracks["audio"].set_source(audio_playback.audio)
-                if video_recorder:
-                    video_playback = MediaPlayer(mp4_file, format="mp4")
-                    output_tracks["video"].set_source(video_playback.video)
-                log_info("Waiting for playback to finish")
-                await asyncio.sleep(10)
-            log_info("Stopping playback")
-            output_tracks["audio"].set_source(bye.audio)
-            log_info("Waiting for end message")
-            await asyncio.sleep(5)
-            log_info("Hanging up")
-            self.conns.pop(unique_id, None)
-            hangup = CallHangupEventContent(call_id=evt.content.call_id, version=1,
-                                            party_id=self.party_id)
-            await self.client.send_message_event(evt.room_id, EventType.CALL_HANGUP, hangup)
-            await pc.close()
-
-        @pc.on("connectionstatechange")
-        async def on_connectionstatechange() -> None:
-            log_info("Connection state is %s", pc.connectionState)
-            if pc.connectionState == "failed":
-                await pc.close()
-                self.conns.pop(unique_id, None)
-            if pc.connectionState == "connected":
-                asyncio.create_task(task())
-
-        @pc.on("track")
-        def on_track(track: MediaStreamTrack) -> None:
-            input_tracks[track.kind] = track
-            blackhole.addTrack(track)
-            pc.addTrack(output_tracks[track.kind])
+        conn = self.conns[unique_id] = WrappedConn(key=unique_id, pc=pc,
+                                                   candidate_waiter=self.loop.create_future(),
+                                                   prepare_waiter=self.loop.create_future(),
+                                                   output_tracks=output_tracks)
+        self.log_call(conn, "Created for %s", evt.sender)
 
-            @track.on("ended")
-            async def on_ended() -> None:
-                log_info("Track %s ended", track.kind)
-                await blackhole.stop()
+        pc.on("connectionstatechange", partial(self.handle_connection_state_change, conn))
+        pc.on("track", partial(self.handle_track, conn))
 
         await pc.setRemoteDescription(offer)
-        await blackhole.start()
 
-        log_info("Ready to receive candidates")
+        self.log_call(conn, "Ready to receive candidates")
         conn.prepare_waiter.set_result(None)
-        await self.client.send_receipt(evt.room_id, evt.event_id)
-        await conn.candidate_waiter
-        log_info("Got candidates")
-
-        answer = await pc.createAnswer()
-        await pc.setLocalDescription(answer)
-
-        response = CallAnswerEventContent(call_id=evt.content.call_id,
-                                          party_id=self.party_id,
-                                          version=1,
-                                          answer=CallData(
-                                              sdp=pc.localDescription.sdp,
-                                              type=CallDataType(pc.localDescription.type),
-                                          ))
-        await self.client.send_message_event(evt.room_id, EventType.CALL_ANSWER, response)
+        # The receipt doesn't need to be done before answering, so don't wait for it yet
+        receipt = self.create_task(self.client.send_receipt(evt.room_id, evt.event_id))
+
+        def candidate_timeout() -> None:
+            if not conn.candidate_waiter.done():
+                conn.candidate_waiter.set_exception(asyncio.TimeoutError())
+
+        timeout_handle = self.loop.call_later(CANDIDATE_TIMEOUT, candidate_timeout)
+        try:
+            try:
+                await conn.candidate_waiter
+            except asyncio.CancelledError:
+                if self.conns.get(unique_id) is conn:
+                    # The invite handler itself was cancelled rather than the call ending
+                    raise
+                self.log_call(conn, "Call ended before candidates were received")
+                return
+            except asyncio.TimeoutError:
+                self.log_call(conn, "Timed out waiting for candidates")
+                self.stop_draining(conn)
+                if self.conns.pop(unique_id, None) is None:
+                    return
+                hangup = CallHangupEventContent(call_id=evt.content.call_id, version=1,
+                                                party_id=self.party_id)
+                await self.client.send_message_event(evt.room_id, EventType.CALL_HANGUP, hangup)
+                await pc.close()
+                return
+            finally:
+                timeout_handle.cancel()
+            self.log_call(conn, "Got candidates")
+
+            answer = await pc.createAnswer()
+            await pc.setLocalDescription(answer)
+
+            response = CallAnswerEventContent(call_id=evt.content.call_id,
+                                              party_id=self.party_id,
+                                              version=1,
+                                              answer=CallData(
+                                                  sdp=pc.localDescription.sdp,
+                                                  type=CallDataType(pc.localDescription.type),
+                                              ))
+            await self.client.send_message_event(evt.room_id, EventType.CALL_ANSWER, response)
+        finally:
+            await receipt